@@ -1,10 +1,104 @@
 import os
 import json
 import re
+import random
+import asyncio
+import hashlib
+import functools
+import importlib.util
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-import yaml
 import argparse
-from openai import OpenAI  # or your local client wrapper
+from openai import (  # or your local client wrapper
+    APIConnectionError,
+    APIError,
+    AsyncOpenAI,
+    InternalServerError,
+    RateLimitError,
+)
+
+try:
+    import tomllib  # Python 3.11+
+except ImportError:
+    import tomli as tomllib
+
+try:
+    import orjson  # faster JSON parse/dump when installed
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+
+    def _json_dumps_sorted(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+else:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+    def _json_dumps_sorted(obj):
+        return json.dumps(obj, sort_keys=True).encode("utf-8")
+
+try:
+    # httpx client preconfigured with the SDK's own timeouts, so only the pool limits need setting
+    import httpx
+    from openai import DefaultAsyncHttpxClient
+except ImportError:
+    httpx = DefaultAsyncHttpxClient = None
+
+# HTTP/2 lets concurrent requests share one connection, but httpx needs the h2 package for it
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+try:
+    # Rust-backed splitter with Unicode sentence boundaries, used with --advanced-splitter
+    from semantic_text_splitter import TextSplitter
+except ImportError:
+    TextSplitter = None
+
+try:
+    import json_repair  # fixes slightly malformed model JSON when installed
+except ImportError:
+    json_repair = None
+
+# Patterns and tables used to clean up every model response, compiled once at import time
+_SMART_QUOTES = str.maketrans({"\u201c": '"', "\u201d": '"'})
+_NEWLINE_RE = re.compile(r'\s*\n\s*')
+_UNSAFE_FILENAME_CHARS = str.maketrans({ch: "_" for ch in '/\\:*?"<>|'})
+
+# Strict schema for servers that support structured outputs (json_schema: true in the config)
+_PIECE_SCHEMA = {
+    "name": "piece",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {"title": {"type": "string"}, "body": {"type": "string"}},
+        "required": ["title", "body"],
+        "additionalProperties": False,
+    },
+}
+
+# Batched requests (--chunks-per-request) return one piece per phrase, in order
+_PIECES_SCHEMA = {
+    "name": "pieces",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {"pieces": {"type": "array", "items": _PIECE_SCHEMA["schema"]}},
+        "required": ["pieces"],
+        "additionalProperties": False,
+    },
+}
+
+# A sentence runs from its first non-space character to the first ".", "!" or "?"
+# that is followed by whitespace, or to the end of the text
+_SENTENCE_RE = re.compile(r'\S.*?(?:[.!?](?=\s|\Z)|\Z)', re.S)
+
+# Source files are read in blocks of this many characters when chunking
+_READ_BLOCK_SIZE = 64 * 1024
 
 
 def chunk_text(text, max_length):
@@ -26,53 +120,772 @@ def chunk_text(text, max_length):
     if len(text) <= max_length:
         return [text]
 
-    chunks = []
-    current_chunk = ""
-    # Split text into sentences, replacing newlines with spaces for consistency
-    sentences = text.replace("\n", " ").split(". ")
+    return list(iter_chunks(_iter_sentences(text), max_length))
 
-    for sentence in sentences:
-        # Check if adding the next sentence would exceed max_length
-        if len(current_chunk) + len(sentence) < max_length:
-            # If not, add the sentence to current chunk
-            current_chunk += sentence + ". "
+
+def iter_chunks(sentences, max_length):
+    """Yield chunks built from an iterable of sentences, one chunk at a time.
+
+    This is the streaming core of chunk_text: sentences are pulled lazily, so
+    only the current chunk and a short lookahead (at most 20% of max_length,
+    used to decide whether the tail should be merged) are held in memory.
+
+    Args:
+        sentences (iterable): Sentences, each including its closing punctuation
+        max_length (int): Maximum character length for each chunk
+
+    Yields:
+        str: Text chunks, each under max_length characters
+    """
+    sentences = iter(sentences)
+    merge_limit = max_length * 0.2
+    # Sentences read ahead to measure the remaining text but not yet placed in a chunk
+    lookahead = deque()
+    # Accumulate sentences in a list and join them with spaces once per chunk
+    current_parts = []
+    current_len = 0
+
+    while True:
+        if lookahead:
+            sentence = lookahead.popleft()
         else:
-            # If adding sentence would exceed max_length:
-            # 1. Save the current chunk if it's not empty
-            if current_chunk:
-                # Look ahead to see if this is the second-to-last chunk
-                remaining_text = sentence + ". "
-                remaining_sentences = sentences[sentences.index(sentence) + 1:]
-                for s in remaining_sentences:
-                    remaining_text += s + ". "
-
-                # If the remaining text is less than 20% of max_length,
-                # append it to the current chunk instead of creating a new one
-                if len(remaining_text) < (max_length * 0.2):
-                    current_chunk += remaining_text
-                    print(f"Adding final merged chunk of length: {len(current_chunk)}")
-                    chunks.append(current_chunk.strip())
-                    current_chunk = ""
+            sentence = next(sentences, None)
+            if sentence is None:
+                break
+
+        # Check if adding the next sentence (and its separating space) would exceed max_length
+        added_len = len(sentence) + 1 if current_parts else len(sentence)
+        if current_len + added_len < max_length:
+            # If not, add the sentence to current chunk
+            current_parts.append(sentence)
+            current_len += added_len
+        elif current_parts:
+            # If adding sentence would exceed max_length, save the current chunk.
+            # Read ahead just far enough to tell whether the remaining text is
+            # less than 20% of max_length, in which case it is appended to the
+            # current chunk instead of creating a new one
+            remaining_len = len(sentence) + 1 + sum(len(s) + 1 for s in lookahead)
+            while remaining_len < merge_limit:
+                ahead = next(sentences, None)
+                if ahead is None:
                     break
-                else:
-                    print(f"Adding chunk of length: {len(current_chunk)}")
-                    chunks.append(current_chunk.strip())
-                    current_chunk = sentence + ". "
-            else:
-                # Start a new chunk with the current sentence
-                current_chunk = sentence + ". "
+                lookahead.append(ahead)
+                remaining_len += len(ahead) + 1
+
+            if remaining_len < merge_limit:
+                current_parts.append(sentence)
+                current_parts.extend(lookahead)
+                current_chunk = " ".join(current_parts)
+                print(f"Adding final merged chunk of length: {len(current_chunk)}")
+                yield current_chunk.strip()
+                return
+
+            print(f"Adding chunk of length: {current_len}")
+            yield " ".join(current_parts).strip()
+            current_parts = [sentence]
+            current_len = len(sentence)
+        else:
+            # Start a new chunk with the current sentence
+            current_parts = [sentence]
+            current_len = len(sentence)
 
     # Don't forget to add the final chunk if there's anything left
-    if current_chunk:
-        chunks.append(current_chunk.strip())
+    if current_parts:
+        yield " ".join(current_parts).strip()
+
+
+def _iter_sentences(text):
+    """Yield the sentences of ``text``, each ending with its ``.``, ``!`` or ``?``."""
+    return (m.group(0) for m in _SENTENCE_RE.finditer(text))
+
+
+def _stream_sentences(f, head=""):
+    """Yield the sentences of an open text file, reading it in 64 KB blocks.
+
+    Produces the same sentences as ``_iter_sentences`` on the whole file.
+    ``head`` is text already read from the start of ``f``.
+    """
+    buf = head
+    while True:
+        block = f.read(_READ_BLOCK_SIZE)
+        if not block:
+            break
+        buf += block
+        last = None
+        for m in _SENTENCE_RE.finditer(buf):
+            if last is not None:
+                yield last.group(0)
+            last = m
+        # The last sentence may continue in the next block
+        buf = buf[last.start():] if last is not None else ""
+    yield from _iter_sentences(buf)
+
+
+def iter_file_chunks(f, max_length):
+    """Yield the same chunks as ``chunk_text(f.read(), max_length)`` without reading the whole file."""
+    head = f.read(max_length + 1)
+    # Short files are returned untouched, matching chunk_text
+    if len(head) <= max_length:
+        yield head
+        return
+    yield from iter_chunks(_stream_sentences(f, head), max_length)
+
+
+@functools.lru_cache(maxsize=None)
+def _text_splitter(max_length):
+    return TextSplitter(max_length)
+
+
+def _advanced_file_chunks(f, max_length):
+    """Split a whole file with ``semantic_text_splitter``; chunks stay within ``max_length`` characters."""
+    return _text_splitter(max_length).chunks(f.read())
+
+
+def get_file_chunker(advanced=False):
+    """Return the function used to chunk a source file, ``chunker(f, max_length)``.
+
+    ``advanced`` selects ``semantic_text_splitter`` when it is installed; otherwise,
+    or if it is missing, the built-in ``iter_file_chunks`` is used.
+    """
+    if advanced:
+        if TextSplitter is not None:
+            return _advanced_file_chunks
+        print("⚠️  WARNING: semantic-text-splitter is not installed; using the built-in splitter")
+    return iter_file_chunks
+
+
+class _JsonScanner:
+    """Incrementally locate complete top-level JSON objects or arrays in streamed text.
+
+    Text is fed in pieces and scanned once, tracking bracket depth and skipping
+    over string literals (including escaped quotes) so braces inside a title or
+    body do not end a match early. Anything between or around the values, such
+    as code fences or commentary, is ignored, as is a trailing value that never
+    closes. ``spans`` holds ``(start, end)`` offsets into the concatenated text.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._pos = 0
+        self._depth = 0
+        self._start = -1
+        self._in_str = False
+        self._esc = False
+
+    def feed(self, text):
+        """Scan the next piece of text; return True if it completed at least one top-level value."""
+        completed = False
+        depth = self._depth
+        in_str = self._in_str
+        esc = self._esc
+        for i, ch in enumerate(text, self._pos):
+            if depth == 0:
+                if ch == "{" or ch == "[":
+                    self._start = i
+                    depth = 1
+            elif in_str:
+                if esc:
+                    esc = False
+                elif ch == "\\":
+                    esc = True
+                elif ch == '"':
+                    in_str = False
+            elif ch == '"':
+                in_str = True
+            elif ch == "{" or ch == "[":
+                depth += 1
+            elif ch == "}" or ch == "]":
+                depth -= 1
+                if depth == 0:
+                    self.spans.append((self._start, i + 1))
+                    completed = True
+        self._pos += len(text)
+        self._depth = depth
+        self._in_str = in_str
+        self._esc = esc
+        return completed
+
+
+def _json_spans(s):
+    """Return ``(start, end)`` slices of every complete top-level JSON object or array in ``s``."""
+    scanner = _JsonScanner()
+    scanner.feed(s)
+    return scanner.spans
+
+
+def _extract_json(s):
+    """Return the JSON text to parse from a model response, or None if it contains none.
+
+    A single top-level value is returned as-is; several (e.g. objects or arrays
+    emitted one after another) are wrapped together in one array.
+    """
+    spans = _json_spans(s)
+    if not spans:
+        return None
+    if len(spans) == 1:
+        start, end = spans[0]
+        return s[start:end]
+    return "[" + ",".join(s[start:end] for start, end in spans) + "]"
+
+
+def _collect_dicts(root, out):
+    """Append every dict found in ``root``, flattening nested lists, to ``out`` in document order.
+
+    Non-dict, non-list items are ignored.
+    """
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            out.append(item)
+        elif isinstance(item, list):
+            # Reversed so items come off the stack in their original order
+            stack.extend(reversed(item))
+
+
+@functools.lru_cache(maxsize=1024)
+def _safe_title(title):
+    """Turn a piece title into a string that is safe to use in a filename."""
+    # Join words with underscores and replace characters that are unsafe in
+    # filenames or create directories, in a single translate pass
+    safe_title = "_".join(title.translate(_UNSAFE_FILENAME_CHARS).split())
+
+    # Truncate overly long filenames (optional safety)
+    return safe_title[:150]
+
+
+def _check_finished(finish_reason):
+    """Raise ValueError if the server stopped a reply because it hit max_tokens."""
+    if finish_reason == "length":
+        raise ValueError("reply was cut off at max_tokens")
+
+
+async def _stream_json_content(client, **request):
+    """Stream a chat completion and return its text once the first top-level JSON value is complete.
+
+    Whatever the model would send after that value (usually a closing code fence
+    or trailing whitespace) is not waited for: the stream is closed early.
+    """
+    scanner = _JsonScanner()
+    parts = []
+    stream = await client.chat.completions.create(stream=True, **request)
+    try:
+        async for event in stream:
+            if not event.choices:
+                continue
+            delta = event.choices[0].delta.content or ""
+            parts.append(delta)
+            if scanner.feed(delta):
+                break
+            _check_finished(event.choices[0].finish_reason)
+    finally:
+        await stream.close()
+    return "".join(parts)
+
+
+async def _stream_text_content(client, on_text, **request):
+    """Stream a chat completion, handing each piece of text to ``on_text`` as it arrives.
+
+    Returns the whole reply once the stream ends.
+    """
+    parts = []
+    stream = await client.chat.completions.create(stream=True, **request)
+    try:
+        async for event in stream:
+            if not event.choices:
+                continue
+            delta = event.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                on_text(delta)
+            _check_finished(event.choices[0].finish_reason)
+    finally:
+        await stream.close()
+    return "".join(parts)
+
+
+def _parse_response(content, json_mode=False):
+    """Parse a model reply into JSON values, raising ValueError if none can be found.
+
+    In JSON mode the server has already constrained the reply, so it is parsed
+    as-is. Otherwise, or if the server ignored the request for JSON, the reply
+    is cleaned up first and the JSON value(s) are pulled out of it. If that
+    still fails and ``json_repair`` is installed, it gets a last try.
+    """
+    if json_mode:
+        try:
+            return _json_loads(content)
+        except ValueError:
+            pass
+
+    # 1. Normalize smart quotes and remove newlines inside strings
+    content = content.translate(_SMART_QUOTES)
+    content = _NEWLINE_RE.sub(' ', content)
+
+    # 2. Unescape JSON that came back as a string literal (e.g., "\"{...}\"")
+    if content[:1] in ('"', "'") and '\\"' in content:
+        content = content.replace('\\"', '"')
+
+    # 3. Pull out the JSON value(s), ignoring code fences or prose around them
+    candidate = _extract_json(content)
+    try:
+        if candidate is None:
+            raise ValueError("no JSON object or array found")
+        return _json_loads(candidate)
+    except ValueError:
+        if json_repair is None:
+            raise
+
+    # 4. Last resort: let json_repair fix unbalanced brackets, stray commas and the like
+    repaired = json_repair.loads(content)
+    if not isinstance(repaired, (dict, list)) or not repaired:
+        raise ValueError("no JSON object or array found, even after repair")
+    return repaired
+
+
+def _split_template(template, **fields):
+    """Split a ``str.format`` template around its ``{source}`` field and format the rest once.
+
+    Returns ``(before, after)`` so a prompt can be built per chunk with plain
+    concatenation, ``before + source + after``, instead of re-parsing the template.
+    """
+    before, sep, after = template.partition("{source}")
+    if not sep:
+        raise ValueError("Prompt template has no {source} placeholder")
+    return before.format(**fields), after.format(**fields)
+
+
+def _cache_key(payload):
+    """Return a stable cache key covering every field of a request payload."""
+    return hashlib.blake2b(_json_dumps_sorted(payload)).hexdigest()
+
+
+def _read_cached(cache_dir, key):
+    """Return the cached response content for ``key``, or None on a cache miss."""
+    cache_path = os.path.join(cache_dir, f"{key}.json")
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, "rb") as cf:
+            return _json_loads(cf.read())["content"]
+    except (OSError, ValueError, KeyError):
+        # A truncated or hand-edited entry is treated as a miss and overwritten later
+        return None
+
+
+def _write_cached(cache_dir, key, content):
+    """Store response content under ``key``, writing atomically so readers never see a partial file."""
+    cache_path = os.path.join(cache_dir, f"{key}.json")
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as cf:
+        cf.write(_json_dumps({"content": content}))
+    os.replace(tmp_path, cache_path)
+
+
+class SemanticCache:
+    """Second cache tier that reuses the reply to an earlier request for a nearly identical chunk.
+
+    Requests are grouped by everything except the source chunk itself (model,
+    system prompt, prompt template, sampling settings, ...). Within a group,
+    only the chunk is embedded with a small sentence-transformers model and
+    looked up in a FAISS inner-product index; a stored reply is reused when the
+    cosine similarity reaches ``threshold``. Chunks longer than the model's
+    ``max_seq_length`` would be embedded from their start alone, so they skip
+    this tier. Both packages are imported on first use, so they are only
+    needed when ``semantic_cache`` is set in the config.
+    """
+
+    DEFAULT_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+    def __init__(self, cache_dir, threshold=0.95, model_name=DEFAULT_MODEL):
+        self.cache_dir = os.path.join(cache_dir, "semantic")
+        self.threshold = threshold
+        self.model_name = model_name
+        self.hits = 0
+        self._model = None
+        self._tables = {}  # group key -> [faiss index or None, list of replies]
+        self._pending = {}  # (group, chunk) -> embedding computed by lookup(), used by add()
+        self._dirty = set()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_cfg(cls, cfg, cache_dir):
+        """Return a SemanticCache configured by ``semantic_cache`` in the config, or None if it is off."""
+        settings = cfg.get("semantic_cache")
+        if not settings or cache_dir is None:
+            return None
+        if not isinstance(settings, dict):
+            settings = {}
+        return cls(cache_dir, settings.get("threshold", 0.95), settings.get("model", cls.DEFAULT_MODEL))
+
+    @staticmethod
+    def _group(payload, source):
+        # The chunk is cut out of the final user message, so the template around it still counts
+        messages = payload["messages"]
+        before, _, after = messages[-1]["content"].partition(source)
+        last = dict(messages[-1], content=[before, after])
+        return _cache_key(dict(payload, messages=[*messages[:-1], last]))
+
+    def _encode(self, text):
+        # Too-long text would be truncated to its start, so it is not embedded at all
+        if len(self._model.tokenizer.tokenize(text)) + 2 > self._model.max_seq_length:
+            return None
+        return self._model.encode([text], normalize_embeddings=True).astype("float32")
+
+    async def _embed(self, text):
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer
+
+            self._model = SentenceTransformer(self.model_name)
+        # Encoding is CPU-bound, so keep it off the event loop
+        return await asyncio.to_thread(self._encode, text)
+
+    def _table(self, group):
+        table = self._tables.get(group)
+        if table is None:
+            import faiss
+
+            index, replies = None, []
+            index_path = os.path.join(self.cache_dir, f"{group}.faiss")
+            replies_path = os.path.join(self.cache_dir, f"{group}.json")
+            if os.path.exists(index_path) and os.path.exists(replies_path):
+                try:
+                    index = faiss.read_index(index_path)
+                    with open(replies_path, "rb") as rf:
+                        replies = _json_loads(rf.read())
+                except (RuntimeError, OSError, ValueError):
+                    index, replies = None, []
+                # A half-written pair would point the index at the wrong replies, so start over
+                if index is not None and index.ntotal != len(replies):
+                    index, replies = None, []
+            table = self._tables[group] = [index, replies]
+        return table
+
+    async def lookup(self, payload, source):
+        """Return a stored reply for a request whose chunk is similar enough to ``source``, or None."""
+        group = self._group(payload, source)
+        embedding = await self._embed(source)
+        if embedding is None:
+            return None
+        index, replies = self._table(group)
+        if index is not None and index.ntotal:
+            scores, ids = index.search(embedding, 1)
+            if scores[0][0] >= self.threshold:
+                self.hits += 1
+                return replies[ids[0][0]]
+        self._pending[group, source] = embedding
+        return None
+
+    def add(self, payload, source, content):
+        """Remember ``content`` as the reply for chunk ``source``; call after a lookup() miss."""
+        group = self._group(payload, source)
+        embedding = self._pending.pop((group, source), None)
+        if embedding is None:
+            return
+        table = self._table(group)
+        if table[0] is None:
+            import faiss
+
+            table[0] = faiss.IndexFlatIP(embedding.shape[1])
+        table[0].add(embedding)
+        table[1].append(content)
+        self._dirty.add(group)
+
+    def save(self):
+        """Write every group that changed during this run back to disk."""
+        import faiss
+
+        for group in self._dirty:
+            index, replies = self._tables[group]
+            index_path = os.path.join(self.cache_dir, f"{group}.faiss")
+            replies_path = os.path.join(self.cache_dir, f"{group}.json")
+            faiss.write_index(index, index_path + ".tmp")
+            with open(replies_path + ".tmp", "wb") as rf:
+                rf.write(_json_dumps(replies))
+            os.replace(index_path + ".tmp", index_path)
+            os.replace(replies_path + ".tmp", replies_path)
+        self._dirty.clear()
+
+
+def _write_text(path, text):
+    with open(path, "w", encoding="utf-8") as out:
+        out.write(text)
+
+
+def _http_client(concurrency):
+    """Return an HTTP client whose connection pool fits ``concurrency`` requests, or None for the SDK default."""
+    if DefaultAsyncHttpxClient is None:
+        return None
+    return DefaultAsyncHttpxClient(
+        http2=_HTTP2,
+        limits=httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency),
+    )
+
+
+# Failures worth retrying after a pause: rate limits, timeouts, dropped connections and 5xx errors
+_TRANSIENT_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+
+class LLMClientPool:
+    """Spread chat completions over one or more OpenAI-compatible endpoints.
+
+    Each endpoint has its own client, model and concurrency limit. A request
+    goes to the least-loaded endpoint, and moves on to the next one if that
+    endpoint fails with an API or connection error. If every endpoint fails
+    with a transient error, the request is retried after a random,
+    exponentially growing pause, up to ``max_attempts`` times in all.
+    """
+
+    class _Endpoint:
+        def __init__(self, client, model, concurrency):
+            self.client = client
+            self.model = model
+            self.concurrency = concurrency
+            self.in_flight = 0
+            self._sem = None
+
+        @property
+        def sem(self):
+            # Created on first use, inside the running event loop: on Python < 3.10 a
+            # semaphore made before asyncio.run() is bound to a different loop
+            if self._sem is None:
+                self._sem = asyncio.Semaphore(self.concurrency)
+            return self._sem
+
+    def __init__(self, endpoints, max_attempts=6):
+        if not endpoints:
+            raise ValueError("LLMClientPool needs at least one endpoint")
+        self._endpoints = endpoints
+        self.max_attempts = max(1, max_attempts)
+
+    @classmethod
+    def from_cfg(cls, cfg):
+        """Build a pool from the ``endpoints`` list in the config, or from its single ``base_url``.
+
+        Endpoint entries may set ``base_url``, ``api_key``, ``model`` and
+        ``concurrency``; anything left out falls back to the top-level setting.
+        ``max_attempts`` bounds the retries of a failing request.
+        """
+        endpoints = []
+        for ep in cfg.get("endpoints") or [{}]:
+            concurrency = ep.get("concurrency", cfg.get("concurrency", 32))
+            client = AsyncOpenAI(
+                base_url=ep.get("base_url", cfg.get("base_url")),
+                api_key=ep.get("api_key", cfg.get("api_key", "none")),
+                http_client=_http_client(concurrency),
+                # complete() retries on its own; the SDK's built-in retries would multiply max_attempts
+                max_retries=0,
+            )
+            model = ep.get("model", cfg.get("model"))
+            endpoints.append(cls._Endpoint(client, model, concurrency))
+        return cls(endpoints, max_attempts=cfg.get("max_attempts", 6))
+
+    @property
+    def models(self):
+        """The set of models the endpoints send requests to."""
+        return {ep.model for ep in self._endpoints}
+
+    async def complete(self, payload, *, stream_json=False, on_text=None):
+        """Send ``payload`` and return the reply text, retrying transient failures.
+
+        With ``on_text`` the reply is streamed and each piece of text is passed
+        to it as it arrives; once any text has been passed on, a failure is
+        raised rather than retried, so nothing is delivered twice.
+        """
+        delivered = False
+
+        def _forward(text):
+            nonlocal delivered
+            delivered = True
+            on_text(text)
+
+        async def _try_endpoints():
+            # Least loaded first, relative to each endpoint's own limit
+            order = sorted(self._endpoints, key=lambda ep: ep.in_flight / ep.concurrency)
+            for position, ep in enumerate(order, 1):
+                request = dict(payload, model=ep.model or payload.get("model"))
+                ep.in_flight += 1
+                try:
+                    async with ep.sem:
+                        if on_text is not None:
+                            return await _stream_text_content(ep.client, _forward, **request)
+                        if stream_json:
+                            return await _stream_json_content(ep.client, **request)
+                        response = await ep.client.chat.completions.create(**request)
+                        _check_finished(response.choices[0].finish_reason)
+                        return response.choices[0].message.content
+                except APIError as e:
+                    if position == len(order) or delivered:
+                        raise
+                    print(f"⚠️  WARNING: Request to {ep.client.base_url} failed ({e}); trying the next endpoint")
+                finally:
+                    ep.in_flight -= 1
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return await _try_endpoints()
+            except _TRANSIENT_ERRORS as e:
+                if delivered or attempt == self.max_attempts:
+                    raise
+                # Random exponential backoff (1 to 60 s) so concurrent retries do not arrive together
+                delay = max(1.0, random.uniform(0, min(60, 2 ** attempt)))
+                print(f"⚠️  WARNING: Request failed ({e}); retry {attempt} of {self.max_attempts - 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
 
-    return chunks
 
-def process_files(client, cfg, source_dir, *, out_dir, counter_file, start_counter, chunk_size, files_per_chunk):
+def _check_cache_models(client, cfg):
+    """Raise ValueError if an endpoint overrides the top-level ``model`` the cache keys are built from.
+
+    Any endpoint may serve a request, so a reply from one model would be
+    stored, and later replayed, under another model's key.
+    """
+    if client.models != {cfg.get("model")}:
+        raise ValueError(
+            "The response cache is keyed on the top-level 'model', but an endpoint in 'endpoints' "
+            "sets a different one; remove the per-endpoint models or run with --no-cache"
+        )
+
+
+async def cached_complete(
+    client,
+    payload,
+    *,
+    cache_dir=None,
+    stream_json=False,
+    on_text=None,
+    semantic_cache=None,
+    semantic_source=None,
+    parse=None,
+):
+    """Return the stripped reply text for the chat completion ``payload``, consulting the disk cache first.
+
+    ``client`` is an ``LLMClientPool``, which bounds concurrent network
+    requests per endpoint; cache hits do not wait for it. The cache key covers
+    the whole payload (model, messages, temperature, max_tokens, ...), so any
+    change to the request is a miss. ``cache_dir=None`` disables the cache.
+    With ``stream_json`` the reply is streamed and cut off as soon as its
+    first JSON value is complete. With ``on_text`` the reply is streamed in
+    full and handed to ``on_text`` piece by piece (a cached reply is handed
+    over in one piece). When the request is for a single source chunk, pass
+    it as ``semantic_source`` and an exact-match miss is checked against
+    ``semantic_cache`` before the request is sent.
+
+    Empty replies, and replies cut off at ``max_tokens``, raise ValueError and
+    are never stored. With ``parse``, the reply is passed to it and its result
+    is returned instead. A reply that ``parse`` rejects, by raising, is never
+    stored either, and a stored reply that it rejects is treated as a miss and
+    requested again.
+    """
+    def _accept(content):
+        if not content:
+            raise ValueError("empty response from model")
+        return content if parse is None else parse(content)
+
+    if semantic_source is None:
+        semantic_cache = None
+
+    key = None
+    if cache_dir is not None:
+        key = _cache_key(payload)
+        cached = _read_cached(cache_dir, key)
+        if cached is None and semantic_cache is not None:
+            cached = await semantic_cache.lookup(payload, semantic_source)
+        if cached is not None:
+            try:
+                result = _accept(cached)
+            except Exception:
+                # Stored before replies were checked; fetch a fresh one below
+                result = cached = None
+            if cached is not None:
+                if on_text is not None:
+                    on_text(cached)
+                return result
+
+    content = (await client.complete(payload, stream_json=stream_json, on_text=on_text)).strip()
+
+    # Only replies the caller accepts are stored, so a bad one is requested again on the next run
+    result = _accept(content)
+    if key is not None:
+        _write_cached(cache_dir, key, content)
+        if semantic_cache is not None:
+            semantic_cache.add(payload, semantic_source, content)
+    return result
+
+
+def _load_progress(progress_file):
+    """Read a progress log and return ``(done, counter)``.
+
+    ``done`` is the set of ``(source path, chunk index)`` pairs already written
+    and ``counter`` the highest next-counter value recorded, or None if the log
+    is missing or empty.
+    """
+    done = set()
+    counter = None
+    if not os.path.exists(progress_file):
+        return done, counter
+    with open(progress_file, "rb") as pf:
+        for line in pf:
+            try:
+                row = _json_loads(line)
+            except ValueError:
+                # Blank or torn line (e.g. a crash mid-append)
+                continue
+            done.add((row["filename"], row["chunk_index"]))
+            counter = row["counter"] if counter is None else max(counter, row["counter"])
+    return done, counter
+
+
+def _open_progress(progress_file):
+    """Open a progress log for appending, making sure a torn last line does not swallow the next row."""
+    pf = open(progress_file, "ab")
+    if pf.tell() > 0:
+        with open(progress_file, "rb") as existing:
+            existing.seek(-1, os.SEEK_END)
+            if existing.read(1) != b"\n":
+                pf.write(b"\n")
+    return pf
+
+
+def _append_progress(pf, row):
+    """Append one row to an open progress log and force it to disk."""
+    pf.write(_json_dumps(row) + b"\n")
+    pf.flush()
+    os.fsync(pf.fileno())
+
+
+def _persist_counter(counter_file, value):
+    """Write the counter atomically, so a crash never leaves counter_file empty or truncated."""
+    tmp_path = counter_file + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as cf:
+        cf.write(str(value))
+        # Make sure the new value is on disk before it replaces the old one
+        cf.flush()
+        os.fsync(cf.fileno())
+    os.replace(tmp_path, counter_file)
+
+
+async def process_files(
+    client,
+    cfg,
+    source_dir,
+    *,
+    out_dir,
+    counter_file,
+    start_counter,
+    chunk_size,
+    files_per_chunk,
+    chunks_per_request=1,
+    use_cache=True,
+    advanced_splitter=False,
+):
     # If start_counter is provided, use it and ignore any existing counter file.
     # If not provided (None), fall back to the persistent counter file or 1.
     global_counter = start_counter if start_counter is not None else 1
 
+    # Chunks finished by earlier runs are logged next to the counter file, one JSON row per chunk
+    progress_file = os.path.join(os.path.dirname(counter_file), "progress.jsonl")
+    done_chunks = set()
+
     # Initialize/read persistent counter only when start_counter is not explicitly set
     if start_counter is None and os.path.exists(counter_file):
         with open(counter_file, "r") as cf:
@@ -80,163 +893,303 @@ def process_files(client, cfg, source_dir, *, out_dir, counter_file, start_count
             if content.isdigit():
                 global_counter = int(content)
 
+    # Resume state follows the counter: an explicit start_counter starts over
+    if start_counter is None:
+        done_chunks, logged_counter = _load_progress(progress_file)
+        # The log is flushed after every chunk, so it may be ahead of counter_file after a crash
+        if logged_counter is not None:
+            global_counter = max(global_counter, logged_counter)
+    elif os.path.exists(progress_file):
+        os.remove(progress_file)
+
     # Load the prompt template from configuration
     prompt_template = cfg.get("foreground_prompt_template")
     if not isinstance(prompt_template, str) or not prompt_template.strip():
-        raise ValueError("Missing or empty 'foreground_prompt_template' in llm_config.yaml")
+        raise ValueError("Missing or empty 'foreground_prompt_template' in the config file")
 
-    try:
-        for filename in sorted(os.listdir(source_dir)):
-            if not filename.endswith(".txt"):
+    # Only {source} changes per chunk, so fill in everything else once up front
+    prompt_before, prompt_after = _split_template(prompt_template, count=files_per_chunk)
+
+    # Static instructions go first, in their own system message, so the provider can cache the shared prefix
+    def _system_messages(system_prompt):
+        if not (isinstance(system_prompt, str) and system_prompt.strip()):
+            return []
+        system_prompt = system_prompt.format(count=files_per_chunk)
+        if cfg.get("provider") == "anthropic":
+            # Anthropic only caches blocks explicitly marked with cache_control
+            system_content = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+        else:
+            # OpenAI-compatible servers cache a static prefix automatically
+            system_content = system_prompt
+        return [{"role": "system", "content": system_content}]
+
+    prefix_messages = _system_messages(cfg.get("foreground_system_prompt"))
+
+    # Build the full list of (filename, chunk index, chunk) tasks up front so they can be dispatched concurrently
+    tasks = []
+    already_done = 0
+    entries = sorted(
+        (e for e in os.scandir(source_dir) if e.name.endswith(".txt") and e.is_file()),
+        key=lambda e: e.name,
+    )
+    # Empty files and blank chunks would still cost a full request; skip them and record what
+    # was skipped (for this run) next to the counter file. min_chunk_chars opts in to a length floor
+    min_chunk_chars = cfg.get("min_chunk_chars", 0)
+    skipped_count = 0
+    chunker = get_file_chunker(advanced_splitter)
+    skipped_file = os.path.join(os.path.dirname(counter_file), "skipped.txt")
+    with open(skipped_file, "w", encoding="utf-8") as skipped:
+        for entry in entries:
+            if entry.stat().st_size == 0:
+                skipped.write(f"{entry.path}\tempty file\n")
+                skipped_count += 1
                 continue
+            with open(entry.path, "r", encoding="utf-8") as f:
+                for index, chunk in enumerate(chunker(f, chunk_size)):
+                    if (entry.path, index) in done_chunks:
+                        already_done += 1
+                        continue
+                    chunk = chunk.strip()
+                    if not chunk or len(chunk) < min_chunk_chars:
+                        skipped.write(f"{entry.path}\tchunk {index} of {len(chunk)} chars: {chunk!r}\n")
+                        skipped_count += 1
+                        continue
+                    tasks.append((entry.name, index, chunk))
+    if skipped_count:
+        print(f"⚠️  Skipped {skipped_count} empty files or too-short chunks; see {skipped_file}")
+    if already_done:
+        print(f"Skipping {already_done} chunks already processed by an earlier run")
 
-            source_path = os.path.join(source_dir, filename)
-            with open(source_path, "r", encoding="utf-8") as f:
-                text = f.read()
-
-            text_chunks = chunk_text(text, chunk_size)
-            for chunk in text_chunks:
-                prompt = prompt_template.format(count=files_per_chunk, source=chunk)
-
-                response = client.chat.completions.create(
-                    model=cfg["model"],
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.8,
-                    max_tokens=1500,
-                )
-
-                content = response.choices[0].message.content.strip()
-
-                # 1. Normalize smart quotes and remove newlines inside strings
-                content = content.replace("\u201c", '"').replace("\u201d", '"')
-                content = re.sub(r'\s*\n\s*', ' ', content)
-
-                # 2. Strip markdown code fences if present
-                if content.startswith("```"):
-                    lines = content.splitlines()
-                    if lines and lines[0].startswith("```"):
-                        lines = lines[1:]
-                    if lines and lines[-1].startswith("```"):
-                        lines = lines[:-1]
-                    content = "\n".join(lines).strip()
-
-                # 3. Unwrap JSON-looking string (e.g., "\"{...}\"")
-                m = re.fullmatch(r'''["']\s*(\{.*\}|\[.*\])\s*["']''', content)
-                if m:
-                    content = m.group(1).replace('\\"', '"').strip()
-
-                # 4. Trim leading/trailing noise outside first JSON block
-                # Find the first "{" or "[" if present
-                brace_index = content.find("{")
-                bracket_index = content.find("[")
-                candidates = [idx for idx in (brace_index, bracket_index) if idx != -1]
-
-                if candidates:
-                    first_bracket = min(candidates)
-                    if first_bracket > 0:
-                        content = content[first_bracket:].lstrip()
-
-                last_bracket = max(
-                    content.rfind("}") if "}" in content else -1,
-                    content.rfind("]") if "]" in content else -1
-                )
-                if last_bracket != -1 and last_bracket < len(content) - 1:
-                    content = content[:last_bracket + 1].rstrip()
-
-                # 5. If a single object is returned, wrap it in an array
-                if content.startswith("{") and content.endswith("}"):
-                    content = "[" + content + "]"
-
-                # ---
-                # Your existing array handling logic continues here (unchanged)
-                # ---
-
-                # Merge multiple arrays into one
-                array_matches = re.findall(r'\[[^\[\]]*\]', content)
-                if len(array_matches) > 1:
-                    combined_objects = []
-                    for arr in array_matches:
-                        try:
-                            parsed = json.loads(arr)
-                            if isinstance(parsed, list):
-                                combined_objects.extend(parsed)
-                        except:
-                            pass
-                    content = json.dumps(combined_objects)
-
-                # If still multiple objects without brackets, capture and wrap
-                elif content.count("{") > 1 and not content.strip().startswith("["):
-                    objs = re.findall(r'\{[^{}]+\}', content)
-                    if objs:
-                        content = "[" + ",".join(objs) + "]"
-
-                # Final safety check
-                if not content:
-                    print(f"⚠️  WARNING: Empty response from model for file {filename}")
-                    continue
-
-                print(f"Processing {filename}, response length: {len(content)} chars")
-
-                # Final parsing
-                try:
-                    outputs = json.loads(content)
-                    if not isinstance(outputs, list):
-                        outputs = [outputs]
-                except Exception as e:
-                    print(f"❌ Failed to parse JSON for {filename}")
-                    print(f"Raw content:\n{content}")
-                    print(f"Error was: {e}")
-                    continue
-
-                # Normalize outputs into a flat list of dicts
-                normalized_outputs = []
+    # Ask the server to return JSON directly when it can, so replies rarely need clean-up
+    response_format = batch_response_format = None
+    if cfg.get("json_schema"):
+        response_format = {"type": "json_schema", "json_schema": _PIECE_SCHEMA}
+        batch_response_format = {"type": "json_schema", "json_schema": _PIECES_SCHEMA}
+    elif cfg.get("supports_json_mode", True):
+        response_format = batch_response_format = {"type": "json_object"}
 
-                def _collect_dicts(item):
-                    if isinstance(item, dict):
-                        normalized_outputs.append(item)
-                    elif isinstance(item, list):
-                        for sub in item:
-                            _collect_dicts(sub)
-                    else:
-                        # Ignore non-dict, non-list items
-                        pass
+    # Several chunks can share one request, so the system prompt is paid for once per batch
+    batch_template = cfg.get("foreground_batch_template")
+    if chunks_per_request > 1 and not (isinstance(batch_template, str) and batch_template.strip()):
+        print("⚠️  WARNING: No 'foreground_batch_template' in the config; sending one chunk per request")
+        chunks_per_request = 1
+    # The single-chunk system prompt asks for exactly one object, which fights the batch template
+    batch_prefix_messages = prefix_messages
+    if chunks_per_request > 1:
+        if "foreground_batch_system_prompt" in cfg:
+            batch_prefix_messages = _system_messages(cfg["foreground_batch_system_prompt"])
+        elif prefix_messages:
+            print(
+                "⚠️  WARNING: No 'foreground_batch_system_prompt' in the config; batches reuse "
+                "'foreground_system_prompt', and replies that follow it fall back to one request per chunk"
+            )
+    batch_halves = {}
 
-                _collect_dicts(outputs)
+    # Responses are cached on disk so re-runs skip requests that have not changed
+    cache_dir = cfg.get("cache_dir", ".llm_cache") if use_cache else None
+    if cache_dir is not None:
+        _check_cache_models(client, cfg)
+        os.makedirs(cache_dir, exist_ok=True)
+    # Optionally, near-duplicate requests reuse an earlier reply too
+    semantic_cache = SemanticCache.from_cfg(cfg, cache_dir)
+    if semantic_cache is not None and chunks_per_request > 1:
+        # Only single-chunk requests are matched by meaning; batches use the exact cache alone
+        print(
+            "⚠️  WARNING: 'semantic_cache' only applies with --chunks-per-request 1; "
+            "batched requests use the exact cache alone"
+        )
+
+    async def _request(chunks, label):
+        """Send ``chunks`` in one request and return each chunk's list of pieces, in order."""
+        if len(chunks) == 1:
+            user_content = prompt_before + chunks[0] + prompt_after
+            fmt = response_format
+            system_messages = prefix_messages
+        else:
+            n = len(chunks)
+            if n not in batch_halves:
+                batch_halves[n] = _split_template(batch_template, count=files_per_chunk, n=n)
+            before, after = batch_halves[n]
+            phrases = "\n\n".join(f"--- PHRASE {i} ---\n{chunk}" for i, chunk in enumerate(chunks, 1))
+            user_content = before + phrases + after
+            fmt = batch_response_format
+            system_messages = batch_prefix_messages
+        payload = dict(
+            model=cfg.get("model"),
+            messages=[*system_messages, {"role": "user", "content": user_content}],
+            temperature=0.8,
+            max_tokens=1500 * len(chunks),
+        )
+        if fmt is not None:
+            payload["response_format"] = fmt
 
+        def _parse(content):
+            print(f"Processing {label}, response length: {len(content)} chars")
+
+            # Final parsing
+            try:
+                outputs = _parse_response(content, json_mode=fmt is not None)
+            except Exception:
+                print(f"❌ Failed to parse JSON for {label}")
+                print(f"Raw content:\n{content}")
+                raise
+            if len(chunks) == 1:
+                pieces = [outputs]
+            else:
+                # A batched reply must hold exactly one result per phrase, or it cannot be matched up
+                pieces = outputs.get("pieces") if isinstance(outputs, dict) else outputs
+                if not isinstance(pieces, list) or len(pieces) != len(chunks):
+                    found = len(pieces) if isinstance(pieces, list) else 0
+                    raise ValueError(f"expected {len(chunks)} pieces, got {found}")
+
+            # Normalize each chunk's result into a flat list of dicts; a chunk without any
+            # (e.g. [] or a bare string) rejects the reply, so it is never cached
+            normalized = []
+            for piece in pieces:
+                normalized_outputs = []
+                _collect_dicts(piece, normalized_outputs)
                 if not normalized_outputs:
-                    print(f"⚠️  WARNING: No valid objects found in model response for file {filename}")
-                    continue
+                    raise ValueError("no valid objects found in model response")
+                normalized.append(normalized_outputs)
+            return normalized
 
-                for piece in normalized_outputs:
-                    title = str(piece.get("title", f"piece_{global_counter}")).strip() or f"piece_{global_counter}"
-                    body = str(piece.get("body", "")).strip()
+        # When streaming, stop reading as soon as the JSON object is complete. Replies that
+        # _parse rejects are not cached, so the next run asks for those chunks again.
+        return await cached_complete(
+            client,
+            payload,
+            cache_dir=cache_dir,
+            stream_json=cfg.get("stream", True),
+            # Batched replies cover several chunks, so only single-chunk requests use the semantic tier
+            semantic_cache=semantic_cache,
+            semantic_source=chunks[0] if len(chunks) == 1 else None,
+            parse=_parse,
+        )
 
-                    # Sanitize title to create a safe filename
-                    safe_title = "_".join(title.split())
+    async def _one_batch(chunks, labels):
+        label = labels[0] if len(chunks) == 1 else f"batch of {len(chunks)} starting at {labels[0]}"
+        try:
+            return await _request(chunks, label)
+        except Exception as e:
+            if len(chunks) == 1:
+                return [e]
+            # Fall back to one request per chunk, so one bad reply does not lose the whole batch
+            print(f"⚠️  WARNING: Request for {label} failed ({e}); retrying its chunks one at a time")
+            results = await asyncio.gather(
+                *[_request([chunk], label) for chunk, label in zip(chunks, labels)], return_exceptions=True
+            )
+            return [r if isinstance(r, Exception) else r[0] for r in results]
 
-                    # Replace or remove characters that are unsafe in filenames or create directories
-                    invalid_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
-                    for ch in invalid_chars:
-                        safe_title = safe_title.replace(ch, "_")
+    # Output files are written on a small thread pool so disk I/O overlaps with post-processing
+    writer = ThreadPoolExecutor(max_workers=8)
+    pending_writes = []
 
-                    # Truncate overly long filenames (optional safety)
-                    if len(safe_title) > 150:
-                        safe_title = safe_title[:150]
+    # Progress rows wait here until all of their chunk's output files are on disk. Chunks whose
+    # request or parsing failed are never logged, and their replies are kept out of the cache,
+    # so a re-run sends fresh requests for just those chunks.
+    pending_rows = deque()
+    progress = _open_progress(progress_file)
 
-                    fname = f"{global_counter:03d}_{safe_title}.txt"
-                    out_path = os.path.join(out_dir, fname)
+    def _log_written_chunks():
+        # Log finished chunks oldest first, stopping at the first one still being written
+        while pending_rows:
+            row, futures = pending_rows[0]
+            if not all(fut.done() and fut.exception() is None for fut in futures):
+                break
+            pending_rows.popleft()
+            _append_progress(progress, row)
 
-                    # Ensure the parent directory exists (defensive, in case of unexpected separators)
-                    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    batch_tasks = []
+    try:
+        # Identical chunks (repeated boilerplate, duplicate files) are sent to the model only once
+        unique_chunks = list(dict.fromkeys(chunk for _, _, chunk in tasks))
+        if len(unique_chunks) < len(tasks):
+            print(f"Sending {len(unique_chunks)} unique chunks out of {len(tasks)}")
+        labels = {}
+        for filename, _, chunk in tasks:
+            labels.setdefault(chunk, filename)
+        batches = [unique_chunks[i:i + chunks_per_request] for i in range(0, len(unique_chunks), chunks_per_request)]
+        # All requests run concurrently; a failed request only loses its own chunks
+        batch_tasks = [asyncio.ensure_future(_one_batch(batch, [labels[c] for c in batch])) for batch in batches]
+        responses = {}
+        for batch, batch_task in zip(batches, batch_tasks):
+            for position, chunk in enumerate(batch):
+                responses[chunk] = (batch_task, position)
+
+        # Post-process, write and log in submission order so counter assignment stays deterministic.
+        # Each chunk is handled as soon as its request is back, so an interrupted run keeps
+        # everything finished before the interruption. Every occurrence of a duplicated chunk
+        # gets its own copy of the response.
+        for filename, index, chunk in tasks:
+            batch_task, position = responses[chunk]
+            outputs = (await batch_task)[position]
+            if isinstance(outputs, Exception):
+                print(f"❌ Request failed for {filename}: {outputs}")
+                continue
 
-                    with open(out_path, "w", encoding="utf-8") as out:
-                        out.write(body + "\n")
-                    global_counter += 1
+            chunk_files = []
+            chunk_writes = []
+            for piece in outputs:
+                title = str(piece.get("title", f"piece_{global_counter}")).strip() or f"piece_{global_counter}"
+                body = str(piece.get("body", "")).strip()
+
+                fname = f"{global_counter:03d}_{_safe_title(title)}.txt"
+                out_path = os.path.join(out_dir, fname)
+
+                # Ensure the parent directory exists (defensive, in case of unexpected separators)
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+                chunk_files.append(fname)
+                chunk_writes.append(writer.submit(_write_text, out_path, body + "\n"))
+                global_counter += 1
+
+            pending_writes.extend(chunk_writes)
+            pending_rows.append((
+                {
+                    "filename": os.path.join(source_dir, filename),
+                    "chunk_index": index,
+                    "output_files": chunk_files,
+                    "counter": global_counter,
+                },
+                chunk_writes,
+            ))
+            _log_written_chunks()
+
+        # Surface any write errors
+        for pending in pending_writes:
+            pending.result()
 
     finally:
+        # Requests still in flight when the run stops are abandoned
+        for batch_task in batch_tasks:
+            batch_task.cancel()
+        writer.shutdown(wait=True)
+        _log_written_chunks()
+        progress.close()
+
         # Persist updated counter
-        with open(counter_file, "w", encoding="utf-8") as cf:
-            cf.write(str(global_counter))
+        _persist_counter(counter_file, global_counter)
+
+        if semantic_cache is not None:
+            if semantic_cache.hits:
+                print(f"Reused {semantic_cache.hits} replies from the semantic cache")
+            semantic_cache.save()
+
+
+@functools.lru_cache(maxsize=1)
+def load_cfg(path):
+    """Load the configuration at ``path``, parsing it only once per process.
+
+    The config is TOML; older ``.yaml``/``.yml`` configs are still read, with
+    PyYAML imported only for them.
+    """
+    with open(path, "rb") as f:
+        if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+            import yaml
+
+            # libyaml's C loader is several times faster than the pure-Python one
+            return yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+        return tomllib.load(f)
 
 
 def parse_args():
@@ -260,10 +1213,25 @@ def parse_args():
     parser.add_argument("--source-dir", default="data/group2_source", help="Source directory containing input files")
     parser.add_argument("--out-dir", default="output/foreground", help="Output directory for generated files")
     parser.add_argument("--chunk-size", type=int, default=2000, help="Maximum characters per chunk when splitting text")
+    parser.add_argument(
+        "--chunks-per-request",
+        type=int,
+        default=1,
+        help=(
+            "Number of text chunks sent to the model in a single request (1 disables batching). "
+            "Batched replies are cached per batch, so changing this or the chunking re-requests every chunk"
+        ),
+    )
+    parser.add_argument("--no-cache", action="store_true", help="Ignore and do not update the on-disk response cache")
+    parser.add_argument(
+        "--advanced-splitter",
+        action="store_true",
+        help="Chunk source files with semantic-text-splitter, if it is installed",
+    )
     parser.add_argument(
         "--config-file",
-        default="llm_config.yaml",
-        help="Path to YAML configuration file (default: llm_config.yaml)",
+        default="llm_config.toml",
+        help="Path to TOML (or legacy YAML) configuration file (default: llm_config.toml)",
     )
     return parser.parse_args()
 
@@ -272,40 +1240,14 @@ def main():
     args = parse_args()
 
     # Load config
-    with open(args.config_file, "r", encoding="utf-8") as f:
-        cfg = yaml.safe_load(f)
-
-    client = OpenAI(base_url=cfg["base_url"], api_key=cfg["api_key"])
-    counter_file = "counter.txt"
-
-    os.makedirs(args.out_dir, exist_ok=True)
-    process_files(
-        client=client,
-        cfg=cfg,
-        source_dir=args.source_dir,
-        out_dir=args.out_dir,
-        counter_file=counter_file,
-        start_counter=args.start_counter,
-        chunk_size=args.chunk_size,
-        files_per_chunk=args.files_per_chunk,
-    )
-
-if __name__ == "__main__":
-    main()
-
-
-def main():
-    args = parse_args()
-
-    # Load config
-    with open("llm_config.yaml", "r", encoding="utf-8") as f:
-        cfg = yaml.safe_load(f)
+    cfg = load_cfg(args.config_file)
 
-    client = OpenAI(base_url=cfg["base_url"], api_key=cfg["api_key"])
+    # One client per configured endpoint; each bounds its own in-flight requests
+    client = LLMClientPool.from_cfg(cfg)
     counter_file = "counter.txt"
 
     os.makedirs(args.out_dir, exist_ok=True)
-    process_files(
+    asyncio.run(process_files(
         client=client,
         cfg=cfg,
         source_dir=args.source_dir,
@@ -314,7 +1256,10 @@ def main():
         start_counter=args.start_counter,
         chunk_size=args.chunk_size,
         files_per_chunk=args.files_per_chunk,
-    )
+        chunks_per_request=max(1, args.chunks_per_request),
+        use_cache=not args.no_cache,
+        advanced_splitter=args.advanced_splitter,
+    ))
 
 if __name__ == "__main__":
     main()
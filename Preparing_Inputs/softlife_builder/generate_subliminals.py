@@ -1,12 +1,23 @@
 import os
+import re
+import asyncio
 from io import TextIOWrapper
 from typing import Any
 
-import yaml
 import argparse
-from openai import OpenAI  # or your local client wrapper
 
-from generate_foregrounds import chunk_text
+from generate_foregrounds import (
+    LLMClientPool,
+    SemanticCache,
+    _check_cache_models,
+    _split_template,
+    cached_complete,
+    get_file_chunker,
+    load_cfg,
+)
+
+# Leading list numbering such as "1.", "2)" or "3 " that models add despite the prompt
+_LEAD_NUM = re.compile(r'^\s*\d+[.)]?\s*')
 
 prompt_template = """
 Extract 2 short, punchy affirmations (3–12 words each) from this text.
@@ -17,11 +28,20 @@ TEXT:
 {source}
 """
 
+# Only {source} changes per chunk, so the rest of the prompt is formatted once at import time
+_PROMPT_BEFORE, _PROMPT_AFTER = _split_template(prompt_template, count=7)
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Generate subliminal files from source texts.")
     parser.add_argument("--source-dir", default="data/group2_source", help="Source directory containing input files")
     parser.add_argument("--out-dir", default="output/subliminals", help="Output directory for generated files")
     parser.add_argument("--chunk-size", type=int, default=2000, help="Maximum characters per chunk when splitting text")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore and do not update the on-disk response cache")
+    parser.add_argument(
+        "--advanced-splitter",
+        action="store_true",
+        help="Chunk source files with semantic-text-splitter, if it is installed",
+    )
     return parser.parse_args()
 
 
@@ -29,45 +49,238 @@ def main():
     args = parse_args()
 
     # Load config
-    with open("llm_config.yaml") as f:
-        cfg = yaml.safe_load(f)
+    cfg = load_cfg("llm_config.toml")
 
-    client = OpenAI(base_url=cfg["base_url"], api_key=cfg["api_key"])
+    client = LLMClientPool.from_cfg(cfg)
     os.makedirs(args.out_dir, exist_ok=True)
 
-    for filename in os.listdir(args.source_dir):
-        if not filename.endswith(".txt"):
-            continue
-        with open(os.path.join(args.source_dir, filename)) as f:
-            text = f.read()
+    asyncio.run(process_files(
+        client,
+        cfg,
+        args.source_dir,
+        out_dir=args.out_dir,
+        chunk_size=args.chunk_size,
+        use_cache=not args.no_cache,
+        advanced_splitter=args.advanced_splitter,
+    ))
+
+
+async def process_files(client, cfg, source_dir, *, out_dir, chunk_size, use_cache=True, advanced_splitter=False):
+    # Build the full list of (filename, chunk index, chunk) tasks up front so they can be dispatched concurrently
+    entries = sorted(
+        (e for e in os.scandir(source_dir) if e.name.endswith(".txt") and e.is_file()),
+        key=lambda e: e.name,
+    )
+    # Source files are read and chunked on worker threads, several at once
+    chunker = get_file_chunker(advanced_splitter)
+    file_chunks = await asyncio.gather(
+        *[asyncio.to_thread(_read_chunks, e.path, chunk_size, chunker) for e in entries]
+    )
+    tasks = []
+    for entry, chunks in zip(entries, file_chunks):
+        for index, chunk in enumerate(chunks):
+            tasks.append((entry.name, index, chunk))
+
+    # Responses are cached on disk (shared with the foreground generator) so re-runs skip unchanged requests
+    cache_dir = cfg.get("cache_dir", ".llm_cache") if use_cache else None
+    if cache_dir is not None:
+        _check_cache_models(client, cfg)
+        os.makedirs(cache_dir, exist_ok=True)
+    # Optionally, near-duplicate requests reuse an earlier reply too
+    semantic_cache = SemanticCache.from_cfg(cfg, cache_dir)
 
-        text_chunks = chunk_text(text, args.chunk_size)
-        for chunk in text_chunks:
-    
-            outputs = generate_lines(cfg, chunk, client)
-            fname = f"{os.path.splitext(filename)[0]}_subliminals_{text_chunks.index(chunk):03d}.txt"
-            with open(os.path.join(args.out_dir, fname), "a") as out:
-                write_lines(out, outputs)
+    # Identical chunks (repeated boilerplate, duplicate files) are sent to the model only once,
+    # and the reply is written to the output file of every occurrence
+    groups = {}
+    for filename, index, chunk in tasks:
+        out_path = os.path.join(out_dir, f"{os.path.splitext(filename)[0]}_subliminals_{index:03d}.txt")
+        groups.setdefault(chunk, []).append((filename, index, out_path))
+    if len(groups) < len(tasks):
+        print(f"Sending {len(groups)} unique chunks out of {len(tasks)}")
 
+    # All output files are written by one background task
+    output = _OutputWriter()
+    try:
+        # A failed request only loses its own chunk instead of aborting the whole run
+        results = await asyncio.gather(
+            *[
+                generate_lines(
+                    cfg,
+                    chunk,
+                    client,
+                    [out_path for _, _, out_path in occurrences],
+                    output,
+                    cache_dir=cache_dir,
+                    semantic_cache=semantic_cache,
+                )
+                for chunk, occurrences in groups.items()
+            ],
+            return_exceptions=True,
+        )
+    finally:
+        await output.aclose()
 
-def write_lines(out: TextIOWrapper, outputs):
+    for occurrences, outputs in zip(groups.values(), results):
+        if isinstance(outputs, Exception):
+            for filename, index, _ in occurrences:
+                print(f"❌ Request failed for {filename}, chunk {index}: {outputs}")
+
+    if semantic_cache is not None:
+        if semantic_cache.hits:
+            print(f"Reused {semantic_cache.hits} replies from the semantic cache")
+        semantic_cache.save()
+
+
+def _read_chunks(path, chunk_size, chunker):
+    with open(path, "r", encoding="utf-8") as f:
+        return list(chunker(f, chunk_size))
+
+
+def write_lines(out: TextIOWrapper, outputs, seen=None):
     for line in outputs:
         # Ollama / Mistral really wants to number the affirmations. So, we remove the numbers.
-        out.write(''.join(char for char in line.strip() if not (char.isdigit() or (char == '.' and any(
-            c.isdigit() for c in line[max(0, line.index(char) - 1):line.index(char)])))) + "\n")
+        cleaned = _LEAD_NUM.sub('', line.strip())
+        if not cleaned:
+            continue
+        # Lines already in the file (e.g. a cached reply replayed by a re-run) are not appended again
+        if seen is not None:
+            if cleaned in seen:
+                continue
+            seen.add(cleaned)
+        out.write(cleaned + "\n")
+
+
+def _parse_lines(content):
+    """Split a reply into lines, raising ValueError if none of them holds an affirmation."""
+    lines = content.splitlines()
+    if not any(_LEAD_NUM.sub('', line.strip()) for line in lines):
+        raise ValueError("no affirmations in response")
+    return lines
 
 
-def generate_lines(cfg, chunk, client) -> Any:
-    prompt = prompt_template.format(count=7, source=chunk)
+class _OutputWriter:
+    """Single background task that performs every output-file write, off the event loop.
 
-    response = client.chat.completions.create(
-        model=cfg["model"],
+    Requests hand over ``(path, lines)`` without blocking. The task drains
+    whatever has queued up, then appends it on a worker thread, keeping each
+    file open until its request is finished. Lines the file already holds
+    are skipped.
+    """
+
+    def __init__(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    def write(self, path, lines):
+        self._queue.put_nowait((path, lines))
+
+    def close_file(self, path):
+        self._queue.put_nowait((path, None))
+
+    async def aclose(self):
+        """Wait until everything queued so far is written, then stop the task."""
+        self._queue.put_nowait(None)
+        await self._task
+
+    async def _run(self):
+        handles = {}
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                while not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                if await asyncio.to_thread(self._apply, handles, batch):
+                    break
+        finally:
+            for handle, _ in handles.values():
+                handle.close()
+
+    @staticmethod
+    def _apply(handles, batch):
+        # Returns True once the stop marker queued by aclose() is reached
+        for item in batch:
+            if item is None:
+                return True
+            path, lines = item
+            if lines is None:
+                opened = handles.pop(path, None)
+                if opened is not None:
+                    opened[0].close()
+                continue
+            opened = handles.get(path)
+            if opened is None:
+                seen = set()
+                if os.path.exists(path):
+                    with open(path, "r", encoding="utf-8") as existing:
+                        seen.update(line.rstrip("\n") for line in existing)
+                opened = handles[path] = (open(path, "a", encoding="utf-8"), seen)
+            handle, seen = opened
+            write_lines(handle, lines, seen)
+        return False
+
+
+class _LineWriter:
+    """Send each complete line of a streamed reply to ``output`` for every path in ``paths`` as soon as it arrives."""
+
+    def __init__(self, paths, output):
+        self.paths = paths
+        self.output = output
+        self._buffer = ""
+
+    def feed(self, text):
+        self._buffer += text
+        *lines, self._buffer = self._buffer.split("\n")
+        if lines:
+            self._write(lines)
+
+    def close(self):
+        if self._buffer:
+            self._write([self._buffer])
+            self._buffer = ""
+        for path in self.paths:
+            self.output.close_file(path)
+
+    def _write(self, lines):
+        for path in self.paths:
+            self.output.write(path, lines)
+
+
+async def generate_lines(cfg, chunk, client, out_paths, output, *, cache_dir=None, semantic_cache=None) -> Any:
+    prompt = _PROMPT_BEFORE + chunk + _PROMPT_AFTER
+
+    payload = dict(
+        model=cfg.get("model"),
         messages=[{"role": "user", "content": prompt}],
         temperature=0.8,
         max_tokens=1500,
     )
 
-    outputs = response.choices[0].message.content.splitlines()
+    # Lines go to out_paths while the reply is still being generated, unless streaming is off
+    writer = _LineWriter(out_paths, output)
+    try:
+        if cfg.get("stream", True):
+            outputs = await cached_complete(
+                client,
+                payload,
+                cache_dir=cache_dir,
+                on_text=writer.feed,
+                semantic_cache=semantic_cache,
+                semantic_source=chunk,
+                parse=_parse_lines,
+            )
+        else:
+            outputs = await cached_complete(
+                client,
+                payload,
+                cache_dir=cache_dir,
+                semantic_cache=semantic_cache,
+                semantic_source=chunk,
+                parse=_parse_lines,
+            )
+            writer.feed("\n".join(outputs))
+    finally:
+        writer.close()
+
     return outputs
 
 